@@ -1,8 +1,9 @@
+import functools
+import itertools
 import os
 import calculate_metrics
 import numpy as np
 import pandas as pd
-import skimage
 import utils
 
 from matplotlib import pyplot as plt
@@ -15,50 +16,91 @@ def calc_roc(sorted_labels):
     calculate the ROC curve for an ordered set of binary labels
     sorted_labels : list of the binary ground-truth labels, sorted by the value of the metric
     '''
-    num_positive = sorted_labels.sum()
-    num_negative = (~sorted_labels).sum()
+    sorted_labels = np.asarray(sorted_labels, dtype=bool)
 
-    true_positive_rates, false_positive_rates = [], []
-    for thresh in range(len(sorted_labels)):
-        num_predicted_positive = sorted_labels[:thresh].sum()
-        num_false_positive = (~sorted_labels[:thresh]).sum()
+    # the rates at each threshold are the cumulative counts of negative and positive labels,
+    # accumulated directly into the output; the curve starts at (0, 0) and ends at the
+    # top right point, which is (1, 1) by definition
+    roc_curve = np.zeros((2, len(sorted_labels) + 1))
+    np.cumsum(~sorted_labels, out=roc_curve[0, 1:])
+    np.cumsum(sorted_labels, out=roc_curve[1, 1:])
 
-        true_positive_rates.append(num_predicted_positive / num_positive)
-        false_positive_rates.append(num_false_positive / num_negative)
+    # normalize by the total numbers of negative and positive labels
+    roc_curve /= roc_curve[:, -1:]
+    return roc_curve
 
-    # append the final top right point, which is at (1, 1) by definition
-    true_positive_rates.append(1.0)
-    false_positive_rates.append(1.0)
 
-    roc_curve = np.vstack((false_positive_rates, true_positive_rates))
-    return roc_curve
+def find_closest_index(sorted_values, value):
+    '''
+    find the index of the first element of a sorted array that is closest to a given value
+    (equivalent to `np.argmin((sorted_values - value) ** 2)`, but using a binary search)
+    '''
+    ind = np.searchsorted(sorted_values, value)
+
+    # if the closest element is the one below the value (which wins ties),
+    # find the first occurrence of it, since the sorted array may contain repeated values
+    if ind == len(sorted_values) or (
+        ind > 0 and value - sorted_values[ind - 1] <= sorted_values[ind] - value
+    ):
+        ind = np.searchsorted(sorted_values, sorted_values[ind - 1])
+
+    return ind
+
+
+def sort_labels_by_metric(annotations, metric_name):
+    '''
+    sort the binary ground-truth labels of an annotations dataframe
+    by the value of a given focus metric (in ascending order)
+    '''
+    order = np.argsort(annotations[metric_name].to_numpy(), kind='stable')
+    return annotations.InFocus.to_numpy()[order]
+
+
+@functools.lru_cache
+def compute_stack_metrics(stack_path):
+    '''
+    calculate the focus metrics for each frame of a TIFF stack
+    (memoized, since the metrics depend only on the images and not on the annotations)
+
+    Returns a dataframe indexed by frame with one column per focus metric;
+    the same dataframe is returned by every call, so it must not be modified
+    '''
+    stack = calculate_metrics.load_tif_stack(stack_path)
+
+    return pd.DataFrame(calculate_metrics.compute_all_focus_values(stack))
 
 
 def load_annotations_and_calc_metrics(filepath):
     '''
-    load a set of manual annotations and calculate the focus metrics for each image
+    load a set of manual annotations and append the focus metrics for each image
     '''
     repo_dirpath = utils.find_repo_root(__file__)
-
-    # load the images
-    stack = skimage.io.imread(repo_dirpath / 'experiment_images' / 'sampled_sequence.tif')
+    stack_path = (repo_dirpath / 'experiment_images' / 'sampled_sequence.tif').resolve()
 
     # load the annotations
     annotations = pd.read_csv(filepath)
     annotations['InFocus'] = annotations.InFocus.astype(bool)
 
-    # calculate the metrics and append them to the dataframe
-    for metric_name in calculate_metrics.ALL_FOCUS_METRICS:
-        values = []
-        for im in stack:
-            im, value = calculate_metrics.compute_focus_metric(im, metric_name=metric_name)
-            values.append(value)
-
-        annotations[metric_name] = values
+    # the annotations are in the same order as the frames of the stack
+    stack_metrics = compute_stack_metrics(stack_path)
+    if len(annotations) != len(stack_metrics):
+        raise ValueError(
+            f"The annotations in {filepath} have {len(annotations)} rows "
+            f"but the stack {stack_path} has {len(stack_metrics)} frames"
+        )
 
+    annotations = annotations.join(stack_metrics)
     return annotations
 
 
+def find_annotation_filepaths():
+    '''
+    find the CSV files of manual annotations included in this repo
+    '''
+    repo_dirpath = utils.find_repo_root(__file__)
+    return sorted((repo_dirpath / 'analysis' / 'user_assessments').glob('*.csv'))
+
+
 def filter_annotations_by_modality(annotations, modality_name):
     '''
     filter an annotations dataframe to include only the rows from a given imaging modality
@@ -71,9 +113,9 @@ def filter_annotations_by_modality(annotations, modality_name):
     bf_dic_ind = 90
 
     if modality_name.lower() == 'brightfield':
-        annotations = annotations.iloc[:bf_dic_ind].copy().reset_index()
+        annotations = annotations.iloc[:bf_dic_ind].reset_index()
     elif modality_name.lower() == 'dic':
-        annotations = annotations.iloc[bf_dic_ind:].copy().reset_index()
+        annotations = annotations.iloc[bf_dic_ind:].reset_index()
     else:
         raise ValueError(f"Unknown modality: {modality_name}")
 
@@ -88,8 +130,7 @@ def plot_all_roc_curves():
     and one column for each focus metric
     '''
 
-    repo_dirpath = utils.find_repo_root(__file__)
-    annotation_filepaths = list((repo_dirpath / 'analysis' / 'user_assessments').glob('*.csv'))
+    annotation_filepaths = find_annotation_filepaths()
 
     num_rows = len(IMAGING_MODALITY_NAMES)
     num_cols = len(calculate_metrics.ALL_FOCUS_METRICS)
@@ -98,31 +139,38 @@ def plot_all_roc_curves():
     for filepath in annotation_filepaths:
         annotations_all = load_annotations_and_calc_metrics(filepath)
 
-        for col_ind, metric_name in enumerate(calculate_metrics.ALL_FOCUS_METRICS):
-            for row_ind, modality_name in enumerate(IMAGING_MODALITY_NAMES):
+        for row_ind, modality_name in enumerate(IMAGING_MODALITY_NAMES):
+            annotations = filter_annotations_by_modality(annotations_all, modality_name)
+
+            for col_ind, metric_name in enumerate(calculate_metrics.ALL_FOCUS_METRICS):
                 ax = axs[row_ind][col_ind]
 
-                annotations = filter_annotations_by_modality(annotations_all, modality_name)
-                sorted_labels = annotations.sort_values(by=metric_name, ascending=True).InFocus
+                sorted_labels = sort_labels_by_metric(annotations, metric_name)
 
                 roc_curve = calc_roc(sorted_labels)
                 ax.plot(roc_curve[0, :], roc_curve[1, :], color='#28b', alpha=0.5)
 
-                ax.set_title(
-                    '%s\n%s' % (metric_name.replace('_', ' ').capitalize(), modality_name),
-                    fontsize=10,
-                )
+    # style each axes once, after all of the ROC curves have been plotted
+    for (row_ind, modality_name), (col_ind, metric_name) in itertools.product(
+        enumerate(IMAGING_MODALITY_NAMES), enumerate(calculate_metrics.ALL_FOCUS_METRICS)
+    ):
+        ax = axs[row_ind][col_ind]
+
+        ax.set_title(
+            '%s\n%s' % (metric_name.replace('_', ' ').capitalize(), modality_name),
+            fontsize=10,
+        )
 
-                if row_ind == num_rows - 1:
-                    ax.set_xlabel('False positive rate')
+        if row_ind == num_rows - 1:
+            ax.set_xlabel('False positive rate')
 
-                if col_ind == 0:
-                    ax.set_ylabel('True positive rate')
+        if col_ind == 0:
+            ax.set_ylabel('True positive rate')
 
-                if col_ind > 0:
-                    ax.set_yticks([])
+        if col_ind > 0:
+            ax.set_yticks([])
 
-                ax.set_aspect(1)
+        ax.set_aspect(1)
 
 
 def calc_median_tpr(fpr_thresh):
@@ -131,32 +179,39 @@ def calc_median_tpr(fpr_thresh):
     for a given false positive rate threshold
     '''
 
-    repo_dirpath = utils.find_repo_root(__file__)
-    annotation_filepaths = list((repo_dirpath / 'analysis' / 'user_assessments').glob('*.csv'))
+    annotation_filepaths = find_annotation_filepaths()
+
+    # the summary columns, with one row per annotation file, modality, and metric
+    num_rows = (
+        len(annotation_filepaths)
+        * len(IMAGING_MODALITY_NAMES)
+        * len(calculate_metrics.ALL_FOCUS_METRICS)
+    )
+    modality_names, metric_names = [], []
+    fprs, tprs = np.empty(num_rows), np.empty(num_rows)
 
-    summary_rows = []
+    row_ind = 0
     for filepath in annotation_filepaths:
         annotations_all = load_annotations_and_calc_metrics(filepath)
 
-        for metric_name in calculate_metrics.ALL_FOCUS_METRICS:
-            for modality_name in IMAGING_MODALITY_NAMES:
-                annotations = filter_annotations_by_modality(annotations_all, modality_name)
-                sorted_labels = annotations.sort_values(by=metric_name, ascending=True).InFocus
+        for modality_name in IMAGING_MODALITY_NAMES:
+            annotations = filter_annotations_by_modality(annotations_all, modality_name)
+
+            for metric_name in calculate_metrics.ALL_FOCUS_METRICS:
+                sorted_labels = sort_labels_by_metric(annotations, metric_name)
                 roc_curve = calc_roc(sorted_labels)
 
                 # calculate the true positive rate at the FPR closest
                 # to a given false positive rate
-                ind = np.argmin((roc_curve[0, :] - fpr_thresh) ** 2)
-                summary_rows.append(
-                    {
-                        'modality': modality_name,
-                        'metric': metric_name,
-                        'fpr': roc_curve[0, ind],
-                        'tpr': roc_curve[1, ind],
-                    }
-                )
-
-    summary = pd.DataFrame(summary_rows)
+                ind = find_closest_index(roc_curve[0, :], fpr_thresh)
+                modality_names.append(modality_name)
+                metric_names.append(metric_name)
+                fprs[row_ind], tprs[row_ind] = roc_curve[:, ind]
+                row_ind += 1
+
+    summary = pd.DataFrame(
+        {'modality': modality_names, 'metric': metric_names, 'fpr': fprs, 'tpr': tprs}
+    )
     summary = summary.groupby(['modality', 'metric']).median().reset_index()
     return summary
 
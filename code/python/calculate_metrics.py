@@ -12,20 +12,40 @@ The script also logs each step of the process.
 Results are saved both as images and as a CSV file containing the focus metrics.
 """
 
-import csv
+import argparse
+import concurrent.futures
+import functools
+import itertools
 import logging
 import os
 import pathlib
 import numpy as np
+import pandas as pd
 import skimage
+import tifffile
 import utils
 
+from scipy import ndimage as ndi
+
 ALL_FOCUS_METRICS = [
     'variance_of_intensity_without_blur',
     'variance_of_sobel_magnitude',
     'variance_of_laplacian',
 ]
 
+# the kernels used by `skimage.filters.laplace` (with ksize=3) and `skimage.filters.sobel_h`;
+# they are applied directly so that a whole stack can be filtered frame-wise in a single call
+LAPLACE_KERNEL = np.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]], dtype=float)
+SOBEL_H_KERNEL = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]], dtype=float) / 4
+
+# the 1D kernel used by `skimage.filters.gaussian` with sigma=1 (truncated at four sigma),
+# precomputed once so that the Gaussian blur reduces to two separable 1D correlations
+GAUSSIAN_KERNEL = np.exp(-0.5 * np.arange(-4, 5) ** 2)
+GAUSSIAN_KERNEL /= GAUSSIAN_KERNEL.sum()
+
+# the number of frames that are filtered together when computing the focus metrics of a stack
+FRAMES_PER_BLOCK = 4
+
 
 logging.basicConfig(
     level=logging.INFO,
@@ -36,132 +56,312 @@ logging.basicConfig(
 
 def _normalize_image(image):
     '''
-    Normalize an image to (0, 1)
+    Normalize an image, or each frame of a stack, to (0, 1)
     '''
-    image = skimage.img_as_float(image)
-    image -= image.min()
-    image[image < 0] = 0
-    image /= image.max()
+    image = skimage.img_as_float32(image)
+
+    # `img_as_float32` returns float32 images unchanged, so the minimum is subtracted
+    # out of place to leave the caller's image unmodified; no clipping is needed afterwards,
+    # since the result cannot be negative
+    image = image - image.min(axis=(-2, -1), keepdims=True)
+
+    # constant frames are left at zero rather than divided by zero
+    image_max = image.max(axis=(-2, -1), keepdims=True)
+    np.divide(image, image_max, out=image, where=image_max > 0)
     return image
 
 
-def variance_of_laplacian(image):
+def _variance(image):
+    '''
+    The variance of an image (or of each frame of a stack) in a single pass over the pixels,
+    using Var(X) = E[X^2] - E[X]^2 with the sums accumulated in float64
+    '''
+    pixels = image.reshape(image.shape[:-2] + (-1,))
+    num_pixels = pixels.shape[-1]
+
+    mean = pixels.sum(axis=-1, dtype=np.float64) / num_pixels
+    mean_of_squares = (
+        np.einsum('...i,...i->...', pixels, pixels, dtype=np.float64) / num_pixels
+    )
+    return mean_of_squares - mean**2
+
+
+def _normalized_variance(image):
+    '''
+    The variance of an image (or of each frame of a stack) after normalizing it to (0, 1)
+    (computed from the scale factor of the normalization, without normalizing the image)
+    '''
+    variance = _variance(image)
+    image_range = np.ptp(image, axis=(-2, -1))
+
+    # as in `_normalize_image`, constant frames normalize to zero, so their variance is zero
+    return np.divide(
+        variance, image_range**2, out=np.zeros_like(variance), where=image_range > 0
+    )
+
+
+def _gaussian_blur(image):
+    '''
+    Gaussian blur (with a sigma of one pixel) of an image, or of each frame of a stack,
+    in the last two (spatial) axes
+    '''
+    image = skimage.img_as_float32(image)
+    image = ndi.correlate1d(image, GAUSSIAN_KERNEL, axis=-2, mode='nearest')
+    return ndi.correlate1d(image, GAUSSIAN_KERNEL, axis=-1, mode='nearest')
+
+
+def _convolve_frames(image, kernel):
+    '''
+    Convolve an image, or each frame of a stack, with a 2D kernel
+    '''
+    kernel = kernel.reshape((1,) * (image.ndim - 2) + kernel.shape)
+    return ndi.convolve(image, kernel, mode='reflect')
+
+
+def variance_of_laplacian(image, image_blurred=None):
     '''
     The variance-of-Laplacian focus metric
+    (`image_blurred` is the Gaussian-blurred image, if it has already been computed)
     '''
-    image = skimage.img_as_float(image)
+    if image_blurred is None:
+        image_blurred = _gaussian_blur(image)
 
-    image_blurred = skimage.filters.gaussian(image, sigma=1)
-    image_laplacian = skimage.filters.laplace(image_blurred, ksize=3)
-    image_laplacian = _normalize_image(image_laplacian)
+    image_laplacian = _convolve_frames(image_blurred, LAPLACE_KERNEL)
 
-    return image_laplacian, image_laplacian.var()
+    return image_laplacian, _normalized_variance(image_laplacian)
 
 
-def variance_of_sobel_magnitude(image):
+def variance_of_sobel_magnitude(image, image_blurred=None):
     '''
     The variance-of-sobel focus metric
+    (`image_blurred` is the Gaussian-blurred image, if it has already been computed)
     '''
-    image = skimage.img_as_float(image)
-
-    image_blurred = skimage.filters.gaussian(image, sigma=1)
+    if image_blurred is None:
+        image_blurred = _gaussian_blur(image)
 
     # Compute the x-gradient and y-gradient using Sobel operator
-    image_sobel_h = skimage.filters.sobel_h(image_blurred)
-    image_sobel_v = skimage.filters.sobel_v(image_blurred)
+    image_sobel_h = _convolve_frames(image_blurred, SOBEL_H_KERNEL)
+    image_sobel_v = _convolve_frames(image_blurred, SOBEL_H_KERNEL.T)
 
-    # Compute the normalized magnitude of the gradient
-    image_sobel_magnitude = np.sqrt(image_sobel_h**2 + image_sobel_v**2)
-    image_sobel_magnitude = _normalize_image(image_sobel_magnitude)
+    # Compute the magnitude of the gradient
+    # (in a single pass and in place, to avoid allocating temporaries for the squares and sum)
+    image_sobel_magnitude = np.hypot(image_sobel_h, image_sobel_v, out=image_sobel_h)
 
-    return image_sobel_magnitude, image_sobel_magnitude.var()
+    return image_sobel_magnitude, _normalized_variance(image_sobel_magnitude)
 
 
-def variance_of_intensity(image, blur=False):
+def variance_of_intensity(image, blur=False, image_blurred=None):
     '''
     the variance of intensity as a focus metric
-    (with or without Gaussian blur)
+    (with or without Gaussian blur; `image_blurred` is the Gaussian-blurred image,
+    if it has already been computed)
+
+    Without blur, the computed image would be the unmodified input image, so None is returned
+    in its place (to avoid saving a copy of the raw images)
     '''
-    if blur:
-        image = skimage.filters.gaussian(image, sigma=1)
-    return image, image.var()
+    if not blur:
+        return None, _variance(image)
+
+    image = _gaussian_blur(image) if image_blurred is None else image_blurred
+    return image, _variance(image)
+
 
+# the function that computes each focus metric; all of them take the image
+# and, optionally, the Gaussian-blurred image (as the `image_blurred` keyword argument)
+FOCUS_METRIC_FUNCTIONS = {
+    'variance_of_intensity_without_blur': functools.partial(variance_of_intensity, blur=False),
+    'variance_of_sobel_magnitude': variance_of_sobel_magnitude,
+    'variance_of_laplacian': variance_of_laplacian,
+}
 
-def compute_focus_metric(frame, metric_name):
+
+def compute_focus_metric(frame, metric_name, frame_blurred=None):
     '''
     compute the specified focus metric
+
+    `frame` can be a single frame or a stack of frames (with the frames along the first axis),
+    in which case the computed images are stacks and the metric values are arrays;
+    `frame_blurred` is the Gaussian-blurred frame (or stack), if it has already been computed
     '''
-    if metric_name == 'variance_of_laplacian':
-        return variance_of_laplacian(frame)
-    elif metric_name == 'variance_of_intensity_without_blur':
-        return variance_of_intensity(frame, blur=False)
-    elif metric_name == 'variance_of_sobel_magnitude':
-        return variance_of_sobel_magnitude(frame)
-    else:
-        raise ValueError(f"Unknown focus metric: {metric_name}")
+    try:
+        metric_function = FOCUS_METRIC_FUNCTIONS[metric_name]
+    except KeyError:
+        raise ValueError(f"Unknown focus metric: {metric_name}") from None
 
+    return metric_function(frame, image_blurred=frame_blurred)
 
-def save_computed_image(image, metric_name, stack_id, frame_num):
+
+def _concatenate_focus_metrics(all_focus_metrics_list):
     '''
-    write the computed image to an output directory
+    concatenate the focus metrics computed for consecutive blocks (or chunks) of frames
     '''
-    repo_dirpath = utils.find_repo_root(__file__)
-    output_dir = pathlib.Path(
-        repo_dirpath / 'analysis' / 'processed_images' / metric_name / stack_id
+    all_focus_metrics = {}
+    for metric_name in ALL_FOCUS_METRICS:
+        computed_images, focus_values = zip(
+            *(focus_metrics[metric_name] for focus_metrics in all_focus_metrics_list)
+        )
+        all_focus_metrics[metric_name] = (
+            None if computed_images[0] is None else np.concatenate(computed_images),
+            np.concatenate(focus_values),
+        )
+    return all_focus_metrics
+
+
+def _compute_all_focus_metrics(stack, return_images=True):
+    '''
+    compute all of the focus metrics for a stack, one small block of frames at a time,
+    blurring each block only once for all of the metrics that use the Gaussian-blurred image
+
+    Working block by block bounds the size of the intermediate images and keeps them in cache
+    across the metrics. If `return_images` is False, each computed block is discarded
+    as soon as its metric values are computed, and None is returned in its place
+    '''
+    all_focus_metrics_list = []
+    for start_ind in range(0, len(stack), FRAMES_PER_BLOCK):
+        block = stack[start_ind : start_ind + FRAMES_PER_BLOCK]
+        block_blurred = _gaussian_blur(block)
+
+        block_focus_metrics = {}
+        for metric_name in ALL_FOCUS_METRICS:
+            images, values = compute_focus_metric(
+                block, metric_name, frame_blurred=block_blurred
+            )
+            block_focus_metrics[metric_name] = (images if return_images else None, values)
+
+        all_focus_metrics_list.append(block_focus_metrics)
+
+    return _concatenate_focus_metrics(all_focus_metrics_list)
+
+
+def compute_all_focus_metrics(stack, num_workers=1, return_images=True):
+    '''
+    compute all of the focus metrics for every frame of a stack,
+    in parallel over chunks of frames if `num_workers` is greater than one
+    (the frames are independent, so the chunking does not change the results)
+
+    Returns a dict mapping each metric name to a tuple of the computed images
+    (or None, if `return_images` is False) and the array of metric values, one per frame
+    '''
+    num_chunks = min(num_workers, len(stack))
+    if num_chunks <= 1:
+        return _compute_all_focus_metrics(stack, return_images=return_images)
+
+    chunks = np.array_split(stack, num_chunks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_chunks) as executor:
+        chunk_results = list(
+            executor.map(_compute_all_focus_metrics, chunks, itertools.repeat(return_images))
+        )
+
+    return _concatenate_focus_metrics(chunk_results)
+
+
+def compute_all_focus_values(stack, num_workers=1):
+    '''
+    compute only the values of all of the focus metrics for every frame of a stack,
+    without keeping (or, when in parallel, transferring) the computed images
+
+    Returns a dict mapping each metric name to the array of metric values, one per frame
+    '''
+    all_focus_metrics = compute_all_focus_metrics(
+        stack, num_workers=num_workers, return_images=False
     )
+    return {metric_name: values for metric_name, (_, values) in all_focus_metrics.items()}
+
+
+def load_tif_stack(stack_path):
+    '''
+    load a TIFF stack as a read-only memory map, so that frames are read from disk on demand
+    (TIFF files that cannot be memory-mapped, e.g. compressed ones, are read into memory)
+    '''
+    try:
+        return tifffile.memmap(stack_path, mode='r')
+    except ValueError:
+        return skimage.io.imread(stack_path)
+
+
+def save_computed_images(images, metric_name, stack_id):
+    '''
+    write the computed images for a stack to an output directory, as a single multi-page TIFF
+    '''
+    if images is None:
+        return
+
+    repo_dirpath = utils.find_repo_root(__file__)
+    output_dir = pathlib.Path(repo_dirpath / 'analysis' / 'processed_images' / metric_name)
     os.makedirs(output_dir, exist_ok=True)
 
-    output_path = output_dir / f"{stack_id}_{frame_num}.tif"
-    if image is not None:
-        skimage.io.imsave(output_path, image.astype(np.uint16))
+    # the filtered images are floats, so rescale each frame to the full range of uint16
+    if np.issubdtype(images.dtype, np.floating):
+        images = _normalize_image(images) * np.iinfo(np.uint16).max
+    tifffile.imwrite(output_dir / f"{stack_id}.tif", images.astype(np.uint16))
 
 
-def process_single_tif_stack(stack_path):
+def process_single_tif_stack(stack_path, num_workers=1):
     '''
     Calculate all of the focus metric for each frame of the stack
+    (using `num_workers` processes, each of which handles a chunk of the frames)
     '''
     logging.info(f"Processing TIF stack: {stack_path}")
 
-    original_stack = skimage.io.imread(stack_path)
+    original_stack = load_tif_stack(stack_path)
     logging.info(f"Read TIF stack with {len(original_stack)} frames.")
 
     # Placeholder names (can be adjusted as needed)
     stack_id = "sampled_sequence"
 
-    focus_metrics = []
-    for metric_name in ALL_FOCUS_METRICS:
-        computed_images_focus_values = [
-            compute_focus_metric(frame, metric_name) for frame in original_stack
-        ]
+    all_focus_metrics = compute_all_focus_metrics(original_stack, num_workers=num_workers)
+
+    # the computed images are saved in background threads
+    # while the focus metric values are collected
+    focus_metrics, save_futures = [], []
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for metric_name, (computed_images, focus_values) in all_focus_metrics.items():
+            logging.info(
+                f"Computed {metric_name} for {len(focus_values)} frames of {stack_id}"
+            )
+            save_futures.append(
+                executor.submit(save_computed_images, computed_images, metric_name, stack_id)
+            )
 
-        for frame_num, (image, focus_value) in enumerate(computed_images_focus_values):
-            logging.info(f"Processing frame {frame_num} for {stack_id} using {metric_name}")
-            save_computed_image(image, metric_name, stack_id, frame_num)
             focus_metrics.append(
-                {
-                    'stack_id': stack_id,
-                    'frame_num': frame_num,
-                    'metric_name': metric_name,
-                    'metric_value': focus_value,
-                }
+                pd.DataFrame(
+                    {
+                        'stack_id': stack_id,
+                        'frame_num': np.arange(len(focus_values)),
+                        'metric_name': metric_name,
+                        'metric_value': focus_values,
+                    }
+                )
             )
 
-    return focus_metrics
+    # raise any errors from saving the images
+    for future in save_futures:
+        future.result()
+
+    return pd.concat(focus_metrics, ignore_index=True)
 
 
 if __name__ == "__main__":
+    # the metrics are computed serially by default, since for a stack the size of the one
+    # included in this repo, starting the worker processes costs more than the filtering
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=1,
+        help='the number of processes used to compute the focus metrics (default: 1)',
+    )
+    args = parser.parse_args()
+
     repo_dirpath = utils.find_repo_root(__file__)
     focus_metrics = process_single_tif_stack(
-        pathlib.Path(repo_dirpath / "experiment_images" / "sampled_sequence.tif")
+        pathlib.Path(repo_dirpath / "experiment_images" / "sampled_sequence.tif"),
+        num_workers=args.num_workers,
     )
 
     output_csv_dir = repo_dirpath / 'analysis' / 'measurements'
     os.makedirs(output_csv_dir, exist_ok=True)
 
-    with open(output_csv_dir / 'focus_measures.csv', 'w', newline='') as csvfile:
-        fieldnames = ['stack_id', 'frame_num', 'metric_name', 'metric_value']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(focus_metrics)
+    focus_metrics.to_csv(output_csv_dir / 'focus_measures.csv', index=False)
 
     logging.info("Processing complete.")